@@ -1,36 +1,66 @@
 # Import the modules.
 from datetime import datetime, timedelta
-from flask import Flask, make_response, request, jsonify
+from flask import Flask, make_response, request, jsonify, send_file
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 import jwt
-from pymongo import ASCENDING, DESCENDING, MongoClient
+from pymongo import ASCENDING, DESCENDING, MongoClient, ReturnDocument, UpdateOne, timeout as mongo_timeout
+from pymongo.errors import DuplicateKeyError, PyMongoError
 from bson import ObjectId
+from bson.errors import InvalidId
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from functools import wraps
 import bcrypt
 from dotenv import load_dotenv
+import contextvars
+import json
+import math
+import multiprocessing
 import os
+import tempfile
+import threading
+import time
 
 # Load environment variables file.
 # Here, for security reasons, we are storing the database credentials in a .env file.
 # This file is ignored by Git thus ensuring security of our application.
 load_dotenv()
 
+# Format of the order dates accepted and returned by the API.
+ORDER_DATE_FORMAT = '%Y-%m-%d'
+
+# Custom JSON provider, serialises dates in the same format the orders were originally stored in.
+# This keeps the API responses unchanged now that the order dates are stored as native BSON dates.
+class OrderDateJSONProvider(DefaultJSONProvider):
+    @staticmethod
+    def default(o):
+        if isinstance(o, datetime):
+            return o.strftime(ORDER_DATE_FORMAT)
+        return DefaultJSONProvider.default(o)
+
 # Create the Flask app.
 app = Flask(__name__)
+app.json = OrderDateJSONProvider(app)
 CORS(app)
 
 # Connect to MongoDB
 uri = os.getenv('MONGO_URI')
-client = MongoClient(uri)
+client = MongoClient(uri, maxPoolSize=int(os.getenv('MONGO_MAX_POOL_SIZE', 100)))
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY')
 
 # Connecting to the database and its collections.
-db = client['ikea_database']
+DATABASE_NAME = 'ikea_database'
+db = client[DATABASE_NAME]
 products_collection = db['products']
 customers_collection = db['customers']
 orders_collection = db['orders']
 admins_collection = db['admins']
 blacklist = db['blacklist']
+sales_by_period_collection = db['sales_by_period']
+jobs_collection = db['jobs']
+counters_collection = db['counters']
 
 
 # Creating unique index for username and email in admins collection.
@@ -38,6 +68,40 @@ blacklist = db['blacklist']
 admins_collection.create_index([('username', 1)], unique=True)
 admins_collection.create_index([('email', 1)], unique=True)
 
+# Creating an index on the order date so that date range queries do not scan the whole orders collection.
+orders_collection.create_index([('order_date', 1)])
+
+# Creating a unique index on the sales buckets.
+# Each bucket holds the sales of one product for one day or one month.
+def create_sales_by_period_indexes(collection):
+    collection.create_index([('granularity', 1), ('period_start', 1), ('product_id', 1)], unique=True)
+    collection.create_index([('granularity', 1), ('category', 1), ('period_start', 1)])
+
+create_sales_by_period_indexes(sales_by_period_collection)
+
+# Granularities supported by the sales buckets.
+SALES_GRANULARITIES = ('day', 'month')
+
+# Default statuses of a newly created order.
+DEFAULT_ORDER_STATUS = 'Awaiting'
+DEFAULT_DELIVERY_STATUS = 'Pending'
+
+# Creating a partial unique index on the job key of the active jobs.
+# This ensures that at most one identical job is queued or running at a time, even across server processes.
+jobs_collection.create_index([('job_key', 1)], unique=True, partialFilterExpression={'active': True})
+jobs_collection.create_index([('status', 1), ('expires_at', 1)])
+
+# Background job settings.
+# The results of the jobs are written to files in JOBS_DIR, JOB_CHUNK_SIZE documents at a time, and deleted after JOB_RESULT_TTL.
+# A running job refreshes its heartbeat every JOB_HEARTBEAT_INTERVAL, and is considered lost once it is older than JOB_STALE_AFTER.
+JOBS_DIR = os.getenv('JOBS_DIR', os.path.join(tempfile.gettempdir(), 'inventory_xpert_jobs'))
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', 2))
+JOB_CHUNK_SIZE = int(os.getenv('JOB_CHUNK_SIZE', 500))
+JOB_HEARTBEAT_INTERVAL = timedelta(seconds=int(os.getenv('JOB_HEARTBEAT_INTERVAL', 30)))
+JOB_STALE_AFTER = timedelta(seconds=int(os.getenv('JOB_STALE_AFTER', 300)))
+JOB_RESULT_TTL = timedelta(seconds=int(os.getenv('JOB_RESULT_TTL', 86400)))
+EXPORTABLE_COLLECTIONS = ('products', 'customers', 'orders')
+
 # JWT Authentication, A decorator to check for a valid token.
 # Here, we are using JWT authentication to ensure that only logged in admins can access the endpoints.
 def jwt_required(func):
@@ -55,11 +119,164 @@ def jwt_required(func):
         return func(*args, **kwargs)
     return jwt_required_wrapper
 
+############################ Admission Control ############################
+
+# Budgets of the priority classes, in this server process.
+# Interactive routes are cheap lookups that should stay fast, analytics routes are expensive aggregations.
+# concurrency: requests running at once, queue_size: requests waiting for a slot,
+# queue_timeout_ms: how long a request may wait for a slot, max_time_ms: total time budget passed to MongoDB as maxTimeMS.
+# Keep the sum of the analytics route concurrencies well below MONGO_MAX_POOL_SIZE so that they always leave connections for the interactive routes.
+PRIORITY_CLASSES = {
+    'interactive': {
+        'concurrency': int(os.getenv('INTERACTIVE_CONCURRENCY', 8)),
+        'queue_size': int(os.getenv('INTERACTIVE_QUEUE_SIZE', 32)),
+        'queue_timeout_ms': int(os.getenv('INTERACTIVE_QUEUE_TIMEOUT_MS', 1000)),
+        'max_time_ms': int(os.getenv('INTERACTIVE_MAX_TIME_MS', 5000))
+    },
+    'analytics': {
+        'concurrency': int(os.getenv('ANALYTICS_CONCURRENCY', 2)),
+        'queue_size': int(os.getenv('ANALYTICS_QUEUE_SIZE', 4)),
+        'queue_timeout_ms': int(os.getenv('ANALYTICS_QUEUE_TIMEOUT_MS', 5000)),
+        'max_time_ms': int(os.getenv('ANALYTICS_MAX_TIME_MS', 30000))
+    }
+}
+
+# Per-route overrides of the priority class budgets, keyed by the name of the endpoint function.
+# e.g. ROUTE_BUDGETS='{"fetch_orders_details": {"concurrency": 1, "max_time_ms": 60000}}'
+ROUTE_BUDGETS = json.loads(os.getenv('ROUTE_BUDGETS', '{}'))
+
+# The limiters of all the routes under admission control, keyed by the name of the endpoint function.
+admission_limiters = {}
+
+'''
+This class limits the number of requests of a route running at once.
+Requests beyond the concurrency wait in a bounded queue until a slot frees up or their deadline passes.
+The queue is served in arrival order: a new request waits behind the queued ones even if a slot is free.
+Requests arriving while the queue is full are rejected straight away.
+It keeps counters of the admitted and rejected requests, which are exposed by the admission-stats endpoint.
+'''
+class AdmissionLimiter:
+    def __init__(self, priority, concurrency, queue_size, queue_timeout_ms, max_time_ms):
+        self.priority = priority
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.queue_timeout_ms = queue_timeout_ms
+        self.max_time_ms = max_time_ms
+        self.condition = threading.Condition()
+        self.active = 0
+        self.waiters = deque()
+        self.admitted = 0
+        self.rejected_queue_full = 0
+        self.rejected_deadline = 0
+        self.timed_out = 0
+
+    # Takes a slot, waiting in the queue until the deadline (a time.monotonic() value) if needed.
+    # A waiting request only takes a slot once it is at the head of the queue.
+    # Returns False if the request was rejected.
+    def acquire(self, deadline):
+        with self.condition:
+            if self.active >= self.concurrency or self.waiters:
+                if len(self.waiters) >= self.queue_size:
+                    self.rejected_queue_full += 1
+                    return False
+                waiter = object()
+                self.waiters.append(waiter)
+                try:
+                    while self.waiters[0] is not waiter or self.active >= self.concurrency:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self.rejected_deadline += 1
+                            return False
+                        self.condition.wait(remaining)
+                finally:
+                    self.waiters.remove(waiter)
+                    # The next request in the queue may now be at its head.
+                    self.condition.notify_all()
+            self.active += 1
+            self.admitted += 1
+            return True
+
+    # Frees a slot and wakes up the requests waiting in the queue, of which only the head takes the slot.
+    def release(self):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify_all()
+
+    # Counts a request whose MongoDB queries ran out of time budget.
+    def record_timeout(self):
+        with self.condition:
+            self.timed_out += 1
+
+    # Seconds a rejected client should wait before retrying, sent in the Retry-After header.
+    def retry_after(self):
+        return max(1, math.ceil(self.queue_timeout_ms / 1000))
+
+    def stats(self):
+        with self.condition:
+            return {
+                'priority': self.priority,
+                'concurrency': self.concurrency,
+                'active': self.active,
+                'queue_depth': len(self.waiters),
+                'queue_size': self.queue_size,
+                'admitted': self.admitted,
+                'rejected_queue_full': self.rejected_queue_full,
+                'rejected_deadline': self.rejected_deadline,
+                'timed_out': self.timed_out
+            }
+
+# This function re-raises the MongoDB timeouts caught by a route, so that admission control can answer them with a 504.
+def raise_if_timeout(e):
+    if isinstance(e, PyMongoError) and e.timeout:
+        raise e
+
+'''
+Admission control, A decorator to limit the concurrency of a route.
+The route gets its own limiter, configured from its priority class and any override in ROUTE_BUDGETS.
+Requests that cannot get a slot are shed with a 503 response and a Retry-After header.
+Admitted requests run inside a pymongo timeout, so MongoDB receives the remaining time budget as maxTimeMS.
+When the budget runs out the request fails with a 504 response and a Retry-After header.
+'''
+def admission_control(priority):
+    def decorator(func):
+        budget = dict(PRIORITY_CLASSES[priority])
+        budget.update(ROUTE_BUDGETS.get(func.__name__, {}))
+        limiter = AdmissionLimiter(priority, **budget)
+        admission_limiters[func.__name__] = limiter
+
+        @wraps(func)
+        def admission_control_wrapper(*args, **kwargs):
+            arrival = time.monotonic()
+            deadline = arrival + limiter.max_time_ms / 1000
+            if not limiter.acquire(min(deadline, arrival + limiter.queue_timeout_ms / 1000)):
+                response = make_response(jsonify({'error': 'The server is busy. Please try again later.'}), 503)
+                response.headers['Retry-After'] = str(limiter.retry_after())
+                return response
+            try:
+                with mongo_timeout(max(deadline - time.monotonic(), 0.001)):
+                    return func(*args, **kwargs)
+            except PyMongoError as e:
+                if not e.timeout:
+                    raise
+                limiter.record_timeout()
+                response = make_response(jsonify({'error': 'The request took too long. Please try again later.'}), 504)
+                response.headers['Retry-After'] = str(limiter.retry_after())
+                return response
+            finally:
+                limiter.release()
+        return admission_control_wrapper
+    return decorator
+
 # Checking for database connectivity.
 @app.route('/api/db_connectivity', methods=['GET'])
 def databaseStats():
     return client.admin.command('ping')
 
+# This endpoint returns the queue depth and the admission and rejection counters of every route under admission control.
+@app.route('/api/admission-stats', methods=['GET'])
+def admission_stats():
+    return make_response(jsonify({name: limiter.stats() for name, limiter in admission_limiters.items()}), 200)
+
 # Checking for server connectivity.
 @app.route('/api/server_connectivity', methods=['GET'])
 def serverStats():
@@ -67,34 +284,41 @@ def serverStats():
 
 # This endpoint returns all products.
 @app.route('/api/all-products', methods=['GET'])
+@admission_control('interactive')
 def select_necessary_fields():
     try:
         selected_data = list (products_collection.find({}))
         return make_response(jsonify(selected_data))
     except Exception as e:
+        raise_if_timeout(e)
         return make_response(jsonify({'error': 'An error occurred while fetching the products.', 'details': str(e)}), 500)
 
 # This endpoint returns all customers.
 @app.route('/api/all-customers', methods=['GET'])
+@admission_control('interactive')
 def select_all_customers():
     try:
         selected_data = list (customers_collection.find({}))
         return make_response(jsonify(selected_data))
     except Exception as e:
+        raise_if_timeout(e)
         return make_response(jsonify({'error': 'An error occurred while fetching the customers.', 'details': str(e)}), 500)
 
 # This endpoint returns all orders.
 @app.route('/api/all-orders', methods=['GET'])
+@admission_control('interactive')
 def select_all_orders():
     try:
-        selected_data = list(orders_collection.find({}))
+        selected_data = list(orders_collection.find({}, {'sales_pending': 0}))
         return make_response(jsonify(selected_data))
     except Exception as e:
+        raise_if_timeout(e)
         return make_response(jsonify({'error': 'An error occurred while fetching the orders.', 'details': str(e)}), 500)
 
 # Query Type 1: Select only necessary fields.
 # This endpoint searches for a customer by their customer id.
 @app.route('/api/get-customer-by-customer-id', methods=['GET'])
+@admission_control('interactive')
 def find_customer_by_customer_id():
     customer_id = request.args.get('customer_id', type=int)
     try:
@@ -103,11 +327,13 @@ def find_customer_by_customer_id():
             return make_response(jsonify({'error': 'No customer found.', "See": customer_id}), 404)
         return make_response(jsonify(selected_data),200)
     except Exception as e:
+        raise_if_timeout(e)
         return make_response(jsonify({'error': 'An error occurred while fetching the customer.', 'details': str(e)}), 500)
 
 # Query Type 1: Select only necessary fields.
 # This endpoint returns all customers with the queried membership status.
 @app.route('/api/find-customers-by-membership-status', methods=['GET'])
+@admission_control('interactive')
 def find_customers_by_membership_status():
     try:
         # Use Case: Find customers by their membership status
@@ -119,14 +345,16 @@ def find_customers_by_membership_status():
             return make_response(jsonify({"error": "No customers found with the provided membership status"}), 404)
         return make_response(jsonify(matching_data), 200)
     except Exception as e:
+        raise_if_timeout(e)
         return make_response(jsonify({"error": str(e)}), 500)
 
 # Query Type 2: Match values in an array
 # This endpoint returns orders by their order ids.
 @app.route('/api/find-orders-by-order-ids', methods=['GET'])
+@admission_control('interactive')
 def find_orders_by_order_ids():
     order_ids = request.args.getlist('order_ids', type=int)
-    selected_data = list(orders_collection.find({'_id': {'$in': order_ids}}))
+    selected_data = list(orders_collection.find({'_id': {'$in': order_ids}}, {'sales_pending': 0}))
 
     # Check if any orders were found, else return 404 error.
     if selected_data is None or len(selected_data) == 0:
@@ -136,6 +364,7 @@ def find_orders_by_order_ids():
 # Query Type 2: Match values in an array
 # This endpoint returns products by their product ids.
 @app.route('/api/find-products-by-product-ids', methods=['GET'])
+@admission_control('interactive')
 def find_products_by_product_ids():
     product_ids = request.args.getlist('product_ids', type=int)
     products = list(products_collection.find({'_id': {'$in': product_ids}}))
@@ -147,6 +376,7 @@ def find_products_by_product_ids():
 # Query Type 2: Match values in an array
 # This endpoint returns products with the multiple categories queried.
 @app.route('/api/find-products-by-multiple-categories', methods=['GET'])
+@admission_control('interactive')
 def find_products_by_category():
     try:
         # Use Case: Find products of a specific category
@@ -156,12 +386,14 @@ def find_products_by_category():
             return make_response(jsonify({"error": "No products found for the specified category."}), 404)
         return make_response(jsonify(matching_data), 200)
     except Exception as e:
+        raise_if_timeout(e)
         return make_response(jsonify({"error": e }), 500)
 
 # Query Type 3: Match array elements with multiple criteria
 # Query Type 7: Match elements in arrays with criteria
 # This endpoint returns products within a price range.
 @app.route('/api/find-products-within-price-range', methods=['GET'])
+@admission_control('interactive')
 def find_products_within_price_range():
     try:
         min_price = float(request.args.get('min_price'))
@@ -169,32 +401,35 @@ def find_products_within_price_range():
         matching_data = list(products_collection.find({'price': {'$gte': min_price, '$lte': max_price}}))
         return make_response(jsonify(matching_data))
     except Exception as e:
+        raise_if_timeout(e)
         return make_response(jsonify({'error': str(e)}), 500)
 
 # Query Type 4: Match arrays containing all specified elements
 # Query Type 8: Match arrays with all elements specified
 # This endpoint returns orders with specified number of product types/categories.
 @app.route('/api/orders-with-number-of-products', methods=['GET'])
+@admission_control('analytics')
 def get_orders_by_number_of_products():
     try:
         size = int(request.args.get('num_products'))
         orders = orders_collection.find({'products': {'$size': size}})
 
-        # Gets the orders with all details by calling the fetch_orders_details function.
-        response = fetch_orders_details()
-
-        # Since the response is a JSON object, we convert it to a list.
-        orders_with_details = response.get_json()
+        # Gets the orders with all details using the same aggregation as the fetch_orders_details endpoint.
+        # The endpoint itself is not called so that this request does not take a second admission slot.
+        result, result_map_reduce = perform_orders_details_aggregation(orders_collection)
+        orders_with_details = perform_data_transformation(result, result_map_reduce)
 
         # Filter the orders with the specified number of products.
         orders = [order for order in orders_with_details if len(order['products']) == size]
         return make_response(jsonify(orders))
     except Exception as e:
+        raise_if_timeout(e)
         return make_response(jsonify({"error": str(e)}), 500)
 
 # Query Type 5: Iterate over result sets
 # This endpoint returns products sorted by price specified.
 @app.route('/api/products-sorted-by-price', methods=['GET'])
+@admission_control('interactive')
 def products_sorted_by_price():
     try: 
         sort_order = request.args.get('sort_order', 'asc')
@@ -206,11 +441,13 @@ def products_sorted_by_price():
         result = [product for product in products_collection.find().sort('price', sort_order)]
         return make_response(jsonify(result), 200)
     except Exception as e:
+        raise_if_timeout(e)
         return make_response(jsonify({'error': str(e)}), 500)
 
 # Query Type 6: Query embedded documents and arrays
 # This endpoint finds the customers with the specified email address.(case sensitive)
 @app.route('/api/find-customer-by-email', methods=['GET'])
+@admission_control('interactive')
 def find_customer_by_email():
     target_email = request.args.get('email')
     if not target_email:
@@ -219,11 +456,13 @@ def find_customer_by_email():
         matching_data = list(customers_collection.find({'contact.email': target_email}))
         return jsonify(matching_data)
     except Exception as e:
+        raise_if_timeout(e)
         return make_response(jsonify({"error": str(e)}), 500)
 
 # Query Type 9: Perform text search
 # This endpoint searches for products by their name query parameter (case-insensitive).
 @app.route('/api/search-products-by-name', methods=['GET'])
+@admission_control('interactive')
 def search_products_by_name():
     # Use Case: Search for products by name (case-insensitive)
     search_query = request.args.get('query')
@@ -233,6 +472,7 @@ def search_products_by_name():
 # Query Type 9: Perform text search
 # This endpoint searches for customers by their name query parameter (case-insensitive).
 @app.route('/api/search-customers-by-name', methods=['GET'])
+@admission_control('interactive')
 def find_customers_by_name():
     # Use Case: Find customers with a name containing the specified input
     search_query = request.args.get('query')
@@ -268,7 +508,16 @@ and finally groups them by order ID.
 The result is a list of orders, each with detailed information about the customer, products, and total prices.
 '''
 def perform_left_outer_join(collection):
-    pipeline = [
+    result = list(collection.aggregate(get_left_outer_join_pipeline()))
+
+    if result is None or len(result) == 0:
+        print('No orders found.')
+    else: 
+        return result
+
+# This function returns the aggregation pipeline of the left outer join, so that it can also be iterated as a cursor.
+def get_left_outer_join_pipeline():
+    return [
         {'$unwind': '$products'},
         {'$lookup': {'from': 'customers', 'localField': 'customer_id', 'foreignField': '_id', 'as': 'customer'}},
         {'$unwind': '$customer'},
@@ -300,17 +549,9 @@ def perform_left_outer_join(collection):
         }},
     ]
 
-    result = list(collection.aggregate(pipeline))
-
-    if result is None or len(result) == 0:
-        print('No orders found.')
-    else: 
-        return result
-
 # Query Type 11: Data transformations, Query Type 14: Use aggregation expressions, Query Type 12: Deconstruct array into separate documents
-# This endpoint returns the total number of orders for each customer.
-@app.route('/api/total-orders-per-customer', methods=['GET'])
-def total_orders_per_customer():
+# This function returns the total number of orders for each customer in the customers collection provided as a param.
+def perform_total_orders_aggregation(collection):
     pipeline = [
         {"$lookup": {
             "from": "orders",
@@ -330,7 +571,13 @@ def total_orders_per_customer():
             "_id": 0
         }}
     ]
-    results = list(customers_collection.aggregate(pipeline))
+    return list(collection.aggregate(pipeline))
+
+# This endpoint returns the total number of orders for each customer.
+@app.route('/api/total-orders-per-customer', methods=['GET'])
+@admission_control('analytics')
+def total_orders_per_customer():
+    results = perform_total_orders_aggregation(customers_collection)
 
     if results is None or len(results) == 0:
         return make_response(jsonify({'error': 'No customers found'}), 404)
@@ -351,7 +598,7 @@ def perform_data_transformation(data, result_map_reduce):
         transformed_order = {
             'customerId': order['customer_id'],
             'customerName': order.pop('customer_name'),
-            'orderDate': datetime.strptime(order.pop('order_date'), '%Y-%m-%d').strftime('%d-%m-%Y'),
+            'orderDate': parse_order_date(order.pop('order_date')).strftime('%d-%m-%Y'),
             'products': [
                 {
                     'name': item['product_name'], 
@@ -378,66 +625,78 @@ It calls the `perform_left_outer_join` function to perform the left outer join o
 which returns a list of orders with detailed information about the customer, products, and total prices.
 It calls the `perform_map_reduce` function to perform the map-reduce operation,
 which returns a list of total sales for each customer.
-It then iterates over the result of the left outer join operation,
-calculates the total quantity for each order, and transforms the order data into a new format.
-The transformed order data includes the total sales for each customer, which is obtained from the result of the map-reduce operation.
-The function returns a JSON response containing the transformed order data.
+It then iterates over the result of the left outer join operation and calculates the total quantity for each order.
+The function returns the joined orders along with the map-reduce result, ready to be passed to `perform_data_transformation`.
 '''
+def perform_orders_details_aggregation(orders):
+    result = perform_left_outer_join(orders)
+
+    # Query Type 5: Iterate over result sets.
+    for order in result:
+        order['total_quantity'] = sum(item['quantity'] for item in order['products']) if 'products' in order else 0
+
+    result_map_reduce = perform_map_reduce(orders)
+    return result, result_map_reduce
+
+# This endpoint returns all orders with the customer, product and sales details.
+# The transformed order data includes the total sales for each customer, which is obtained from the result of the map-reduce operation.
 @app.route('/api/fetch-orders-with-details', methods=['GET'])
+@admission_control('analytics')
 def fetch_orders_details():
     try:
         # Copy the orders collection to a new variable.
         # This is done to avoid modifying the original collection.
         orders = db['orders']
-        result = perform_left_outer_join(orders)
-
-        # Query Type 5: Iterate over result sets.
-        for order in result:
-            order['total_quantity'] = sum(item['quantity'] for item in order['products']) if 'products' in order else 0
-
-        result_map_reduce = perform_map_reduce(orders)
+        result, result_map_reduce = perform_orders_details_aggregation(orders)
 
         orders_with_details = perform_data_transformation(result, result_map_reduce)
     except Exception as e:
+        raise_if_timeout(e)
         return make_response(jsonify({'error': str(e)}), 500)
 
     return make_response(jsonify(orders_with_details), 200)
 
 
 # Query Type 14: Use aggregation expressions
-# This endpoint returns the total sales for each customer.
+# This function returns the total sales for each customer in the orders collection provided as a param.
 # It performs an aggregation operation using MongoDB's aggregation pipeline.
-@app.route('/api/total-sales-per-customer', methods=['GET'])
-def total_sales_per_customer():
-    try:
-        pipeline = [
-            {'$unwind': '$products'},
-            {'$lookup': {
-                'from': 'products',
-                'localField': 'products.product_id',
-                'foreignField': '_id',
-                'as': 'product_details'
-                }
-            },
-            {'$unwind': '$product_details'},
-            {
-                '$group': {
-                    '_id': '$customer_id',
-                    'total_sales': {
-                        '$sum': {
-                            '$multiply': ['$products.quantity', '$product_details.price']
-                        }
+def perform_total_sales_aggregation(collection):
+    pipeline = [
+        {'$unwind': '$products'},
+        {'$lookup': {
+            'from': 'products',
+            'localField': 'products.product_id',
+            'foreignField': '_id',
+            'as': 'product_details'
+            }
+        },
+        {'$unwind': '$product_details'},
+        {
+            '$group': {
+                '_id': '$customer_id',
+                'total_sales': {
+                    '$sum': {
+                        '$multiply': ['$products.quantity', '$product_details.price']
                     }
                 }
             }
-        ]
-        result = list(orders_collection.aggregate(pipeline))
-        if not result:
+        }
+    ]
+    result = collection.aggregate(pipeline)
+    return [{'customer_id': item['_id'], 'total_sale': round(item['total_sales'], 2)} for item in result]
+
+# This endpoint returns the total sales for each customer.
+@app.route('/api/total-sales-per-customer', methods=['GET'])
+@admission_control('analytics')
+def total_sales_per_customer():
+    try:
+        formatted_result = perform_total_sales_aggregation(orders_collection)
+        if not formatted_result:
             return make_response(jsonify({'error': 'No orders found'}), 404)
-        formatted_result = [{'customer_id': item['_id'], 'total_sale': round(item['total_sales'], 2)} for item in result]
         return make_response(jsonify(formatted_result))
 
     except Exception as e:
+        raise_if_timeout(e)
         return make_response(jsonify({'error': str(e)}), 500)
 
 
@@ -445,6 +704,7 @@ def total_sales_per_customer():
 # This endpoint updates the order status of an order.
 # It takes the order ID and the new order status as input.
 @app.route('/api/update-order-status', methods=['PUT'])
+@admission_control('interactive')
 def update_order_status():
     # Use Case: Update the status of an order
     order_data = request.get_json()
@@ -458,6 +718,688 @@ def update_order_status():
         return make_response(jsonify({'message': 'Failed to update the status for this order. Please try again!'}), 404)
 
 
+############################ Sales Reporting ############################
+
+# This function converts an order date to a datetime.
+# Orders written before the migration store their date as a '%Y-%m-%d' string, newer ones as a native BSON date.
+def parse_order_date(value):
+    if isinstance(value, datetime):
+        return value
+    return datetime.strptime(value, ORDER_DATE_FORMAT)
+
+# This function returns the start of the day or month bucket the given date falls into.
+def get_period_start(date, granularity):
+    if granularity == 'month':
+        return datetime(date.year, date.month, 1)
+    return datetime(date.year, date.month, date.day)
+
+'''
+This function adds the sales of an order to the daily and monthly buckets in the sales_by_period collection of the given database.
+It looks up the price and category of every product in the order and increments the quantity,
+total sales and order count of the matching buckets, creating them if they do not exist yet.
+The products can be passed in, keyed by their id, when the caller has already fetched them.
+The writes are part of the given session's transaction, if any.
+'''
+def record_order_sales(database, order, products=None, session=None):
+    order_date = parse_order_date(order['order_date'])
+    if products is None:
+        product_ids = [item['product_id'] for item in order.get('products', [])]
+        products = {product['_id']: product for product in database['products'].find({'_id': {'$in': product_ids}}, session=session)}
+
+    operations = []
+    for item in order.get('products', []):
+        product = products.get(item['product_id'])
+        if product is None:
+            continue
+        for granularity in SALES_GRANULARITIES:
+            operations.append(UpdateOne(
+                {'granularity': granularity, 'period_start': get_period_start(order_date, granularity), 'product_id': product['_id']},
+                {
+                    '$set': {'category': product.get('category'), 'product_name': product.get('name')},
+                    '$inc': {
+                        'quantity': item['quantity'],
+                        'total_sales': product['price'] * item['quantity'],
+                        'order_lines': 1
+                    }
+                },
+                upsert=True
+            ))
+    if operations:
+        database['sales_by_period'].bulk_write(operations, ordered=False, session=session)
+
+'''
+This function marks the start or the end of a rebuild of the sales buckets in the given database.
+The state is kept in the sales_by_period counter, which every order creation increments in its transaction.
+Changing it therefore waits for the order creations that already incremented the counter to commit,
+while those that had not yet are retried by MongoDB and see the new state.
+'''
+def set_sales_rebuilding(database, rebuilding):
+    database['counters'].update_one({'_id': 'sales_by_period'}, {'$set': {'rebuilding': rebuilding}}, upsert=True)
+
+# This function records the sales of an order created while the buckets were rebuilt.
+# The order is unflagged in the same transaction that updates its buckets, so it is never counted twice.
+# Returns 1 if the order was replayed, or 0 if it had already been.
+def replay_order_sales(database, order, session):
+    unflagged = database['orders'].update_one({'_id': order['_id'], 'sales_pending': True}, {'$unset': {'sales_pending': ''}}, session=session)
+    if unflagged.modified_count:
+        record_order_sales(database, order, session=session)
+    return unflagged.modified_count
+
+# This function records the sales of all the orders created while the buckets were rebuilt.
+def replay_pending_order_sales(database):
+    replayed = 0
+    with database.client.start_session() as session:
+        for order in database['orders'].find({'sales_pending': True}):
+            replayed += session.with_transaction(lambda session: replay_order_sales(database, order, session))
+    return replayed
+
+'''
+This function rebuilds the sales_by_period collection of the given database from its orders collection.
+It runs a single aggregation for both granularities, truncating the order dates to the start of the day or month,
+and writes the buckets to a staging collection with $out.
+The staging collection then replaces sales_by_period in one rename, so the reports never see a partial collection
+and a failure part way through leaves the current buckets untouched.
+The rename drops any bucket update made to the old collection while the aggregation ran, so order creation stops updating
+the buckets for the duration of the rebuild and flags the new orders with sales_pending instead, see set_sales_rebuilding.
+The aggregation skips those orders, and their sales are replayed into the buckets in use once it is done, whether it succeeded or not.
+If the server dies part way through, the flagged orders are replayed by the next rebuild.
+'''
+def rebuild_sales_by_period(database):
+    staging_collection = database['sales_by_period_staging']
+    staging_collection.drop()
+    create_sales_by_period_indexes(staging_collection)
+    pipeline = [
+        {'$match': {'sales_pending': {'$ne': True}}},
+        {'$unwind': '$products'},
+        {'$lookup': {'from': 'products', 'localField': 'products.product_id', 'foreignField': '_id', 'as': 'product_details'}},
+        {'$unwind': '$product_details'},
+        {'$addFields': {'granularity': {'$literal': list(SALES_GRANULARITIES)}}},
+        {'$unwind': '$granularity'},
+        {'$group': {
+            '_id': {
+                'granularity': '$granularity',
+                'period_start': {'$dateTrunc': {'date': '$order_date', 'unit': '$granularity'}},
+                'product_id': '$products.product_id'
+            },
+            'category': {'$first': '$product_details.category'},
+            'product_name': {'$first': '$product_details.name'},
+            'quantity': {'$sum': '$products.quantity'},
+            'total_sales': {'$sum': {'$multiply': ['$products.quantity', '$product_details.price']}},
+            'order_lines': {'$sum': 1}
+        }},
+        {'$project': {
+            '_id': 0,
+            'granularity': '$_id.granularity',
+            'period_start': '$_id.period_start',
+            'product_id': '$_id.product_id',
+            'category': 1,
+            'product_name': 1,
+            'quantity': 1,
+            'total_sales': 1,
+            'order_lines': 1
+        }},
+        {'$out': 'sales_by_period_staging'}
+    ]
+    set_sales_rebuilding(database, True)
+    try:
+        database['orders'].aggregate(pipeline, allowDiskUse=True)
+        staging_collection.rename('sales_by_period', dropTarget=True)
+    finally:
+        set_sales_rebuilding(database, False)
+        replayed_orders = replay_pending_order_sales(database)
+    return {'buckets': database['sales_by_period'].estimated_document_count(), 'replayed_orders': replayed_orders}
+
+'''
+This endpoint migrates the string order dates to native BSON dates and starts a background job rebuilding the sales buckets.
+The dates are converted by MongoDB in a single update, which only touches orders whose date is still stored as a string,
+so it is safe to run more than once. The rebuild job can be polled like any other job, see the jobs endpoints.
+It is a maintenance endpoint, so it is not under admission control and its queries have no time budget.
+'''
+@app.route('/api/migrate-order-dates', methods=['POST'])
+@jwt_required
+def migrate_order_dates():
+    try:
+        migrated = orders_collection.update_many(
+            {'order_date': {'$type': 'string'}},
+            [{'$set': {'order_date': {'$dateFromString': {'dateString': '$order_date', 'format': ORDER_DATE_FORMAT}}}}]
+        )
+        job, _ = submit_new_job('rebuild-sales-by-period', {})
+        return make_response(jsonify({
+            'message': 'Order dates migrated successfully!',
+            'migrated_orders': migrated.modified_count,
+            'rebuild_job': format_job(job)
+        }), 202)
+    except Exception as e:
+        return make_response(jsonify({'error': str(e)}), 500)
+
+# This function checks that a value is an integer, as bool is a subclass of int in Python.
+def is_integer(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+# This function raises the orders counter to the highest order id, so that it never hands out an id already in use.
+def sync_order_counter():
+    last_order = orders_collection.find_one({}, {'_id': 1}, sort=[('_id', DESCENDING)])
+    counters_collection.update_one({'_id': 'orders'}, {'$max': {'seq': last_order['_id'] if last_order else 0}}, upsert=True)
+
+# This function returns the next order id.
+# The ids come from an atomic counter, so concurrent requests never get the same id.
+def next_order_id():
+    counter = counters_collection.find_one_and_update({'_id': 'orders'}, {'$inc': {'seq': 1}}, return_document=ReturnDocument.AFTER)
+    if counter is None:
+        sync_order_counter()
+        counter = counters_collection.find_one_and_update({'_id': 'orders'}, {'$inc': {'seq': 1}}, return_document=ReturnDocument.AFTER)
+    return counter['seq']
+
+'''
+This endpoint creates a new order.
+It takes the customer id, the products with their quantities and optionally the order date and statuses as input,
+e.g. {"customer_id": 301, "products": [{"product_id": 201, "quantity": 2}], "order_date": "2024-01-31"}.
+The order is validated before anything is written, its total price is computed from the current product prices,
+and it is added to the sales buckets in the same transaction, so a failed request never leaves an order without its sales.
+'''
+@app.route('/api/create-order', methods=['POST'])
+@admission_control('interactive')
+def create_order():
+    try:
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return make_response(jsonify({'error': 'The request body must be a JSON object.'}), 400)
+
+        customer_id = data.get('customer_id')
+        lines = data.get('products')
+        if not is_integer(customer_id) or not isinstance(lines, list) or not lines:
+            return make_response(jsonify({'error': 'An integer customer_id and a non-empty products list are required.'}), 400)
+        for item in lines:
+            if not isinstance(item, dict) or not is_integer(item.get('product_id')) or not is_integer(item.get('quantity')) or item['quantity'] <= 0:
+                return make_response(jsonify({'error': 'Each product needs an integer product_id and a positive integer quantity.'}), 400)
+
+        order_date = data.get('order_date')
+        if order_date is None:
+            order_date = get_period_start(datetime.utcnow(), 'day')
+        elif isinstance(order_date, str):
+            try:
+                order_date = parse_order_date(order_date)
+            except ValueError:
+                return make_response(jsonify({'error': 'order_date must be in the YYYY-MM-DD format.'}), 400)
+        else:
+            return make_response(jsonify({'error': 'order_date must be a string in the YYYY-MM-DD format.'}), 400)
+
+        order_status = data.get('order_status', DEFAULT_ORDER_STATUS)
+        delivery_status = data.get('delivery_status', DEFAULT_DELIVERY_STATUS)
+        if not isinstance(order_status, str) or not isinstance(delivery_status, str):
+            return make_response(jsonify({'error': 'order_status and delivery_status must be strings.'}), 400)
+
+        if customers_collection.find_one({'_id': customer_id}, {'_id': 1}) is None:
+            return make_response(jsonify({'error': 'No customer found.', 'customer_id': customer_id}), 400)
+        product_ids = [item['product_id'] for item in lines]
+        products = {product['_id']: product for product in products_collection.find({'_id': {'$in': product_ids}})}
+        missing_product_ids = [product_id for product_id in product_ids if product_id not in products]
+        if missing_product_ids:
+            return make_response(jsonify({'error': 'No products found.', 'product_ids': missing_product_ids}), 400)
+
+        order = {
+            'customer_id': customer_id,
+            'products': [{'product_id': item['product_id'], 'quantity': item['quantity']} for item in lines],
+            'order_date': order_date,
+            'total_price': round(sum(products[item['product_id']]['price'] * item['quantity'] for item in lines), 2),
+            'delivery_status': delivery_status,
+            'order_status': order_status
+        }
+
+        # While the sales buckets are rebuilt, the order is only flagged and its sales are replayed by the rebuild.
+        def insert_order(session):
+            sales_state = counters_collection.find_one_and_update(
+                {'_id': 'sales_by_period'}, {'$inc': {'seq': 1}}, upsert=True, return_document=ReturnDocument.AFTER, session=session
+            )
+            if sales_state.get('rebuilding'):
+                order['sales_pending'] = True
+            else:
+                order.pop('sales_pending', None)
+            orders_collection.insert_one(order, session=session)
+            if not sales_state.get('rebuilding'):
+                record_order_sales(db, order, products, session)
+
+        # Orders inserted without the counter, e.g. by an import, can still collide with its ids.
+        # In that case the counter is moved past them and the insert is retried.
+        with client.start_session() as session:
+            for attempt in range(3):
+                order['_id'] = next_order_id()
+                try:
+                    session.with_transaction(insert_order)
+                    break
+                except DuplicateKeyError:
+                    sync_order_counter()
+            else:
+                return make_response(jsonify({'error': 'Could not allocate an order id. Please try again!'}), 503)
+
+        return make_response(jsonify({'message': 'Order created successfully!', 'order_id': order['_id']}), 201)
+    except Exception as e:
+        raise_if_timeout(e)
+        return make_response(jsonify({'error': str(e)}), 500)
+
+'''
+This endpoint returns the sales between two dates at a daily or monthly granularity.
+The totals are read from the sales_by_period buckets rather than the orders,
+so the cost of the query depends on the number of buckets in the range and not on the number of orders.
+The results can be grouped by product or by category.
+Monthly results include the whole month of the start and end dates.
+'''
+@app.route('/api/sales-by-period', methods=['GET'])
+@admission_control('analytics')
+def sales_by_period():
+    try:
+        granularity = request.args.get('granularity', 'day')
+        group_by = request.args.get('group_by', 'product')
+        if granularity not in SALES_GRANULARITIES:
+            return make_response(jsonify({'error': 'granularity must be one of day or month.'}), 400)
+        if group_by not in ('product', 'category'):
+            return make_response(jsonify({'error': 'group_by must be one of product or category.'}), 400)
+        try:
+            start_date = get_period_start(parse_order_date(request.args['start_date']), granularity)
+            end_date = get_period_start(parse_order_date(request.args['end_date']), granularity)
+        except (KeyError, ValueError):
+            return make_response(jsonify({'error': 'start_date and end_date are required in the YYYY-MM-DD format.'}), 400)
+
+        match = {'granularity': granularity, 'period_start': {'$gte': start_date, '$lte': end_date}}
+        categories = request.args.getlist('category', type=str)
+        if categories:
+            match['category'] = {'$in': categories}
+
+        group_key = '$product_id' if group_by == 'product' else '$category'
+        pipeline = [
+            {'$match': match},
+            {'$group': {
+                '_id': {'period_start': '$period_start', 'key': group_key},
+                'product_name': {'$first': '$product_name'},
+                'quantity': {'$sum': '$quantity'},
+                'total_sales': {'$sum': '$total_sales'},
+                'order_lines': {'$sum': '$order_lines'}
+            }},
+            {'$sort': {'_id.period_start': 1, '_id.key': 1}}
+        ]
+        result = []
+        for bucket in sales_by_period_collection.aggregate(pipeline):
+            item = {
+                'period_start': bucket['_id']['period_start'],
+                group_by: bucket['_id']['key'],
+                'quantity': bucket['quantity'],
+                'total_sales': round(bucket['total_sales'], 2),
+                'order_lines': bucket['order_lines']
+            }
+            if group_by == 'product':
+                item['product_name'] = bucket['product_name']
+            result.append(item)
+        return make_response(jsonify(result), 200)
+    except Exception as e:
+        raise_if_timeout(e)
+        return make_response(jsonify({'error': str(e)}), 500)
+
+
+############################ Background Jobs ############################
+
+# The process pool running the background jobs. It is created on the first job submission.
+job_executor = None
+job_executor_lock = threading.Lock()
+
+# This function returns the process pool running the background jobs, creating it if needed.
+# The workers are forked so that they share the functions of this module without re-importing it.
+def get_job_executor():
+    global job_executor
+    with job_executor_lock:
+        if job_executor is None:
+            job_executor = ProcessPoolExecutor(max_workers=JOB_WORKERS, mp_context=multiprocessing.get_context('fork'))
+        return job_executor
+
+# This function discards a process pool that broke because one of its workers died.
+# The next job submission creates a new pool.
+def reset_job_executor(executor):
+    global job_executor
+    with job_executor_lock:
+        if job_executor is executor:
+            job_executor = None
+    executor.shutdown(wait=False)
+
+# This function yields the details of every order.
+# It iterates over the aggregation cursor and transforms the joined orders a chunk at a time,
+# so the worker never holds the whole join in memory.
+def orders_details_job(job_db, params):
+    orders = job_db['orders']
+    result_map_reduce = perform_map_reduce(orders)
+    cursor = orders.aggregate(get_left_outer_join_pipeline(), allowDiskUse=True, batchSize=JOB_CHUNK_SIZE)
+    def generate():
+        chunk = []
+        for order in cursor:
+            order['total_quantity'] = sum(item['quantity'] for item in order['products']) if 'products' in order else 0
+            chunk.append(order)
+            if len(chunk) == JOB_CHUNK_SIZE:
+                yield from perform_data_transformation(chunk, result_map_reduce)
+                chunk = []
+        yield from perform_data_transformation(chunk, result_map_reduce)
+    return generate(), orders.estimated_document_count()
+
+# This function returns the total sales for each customer.
+def total_sales_per_customer_job(job_db, params):
+    result = perform_total_sales_aggregation(job_db['orders'])
+    return result, len(result)
+
+# This function returns the total number of orders for each customer.
+def total_orders_per_customer_job(job_db, params):
+    result = perform_total_orders_aggregation(job_db['customers'])
+    return result, len(result)
+
+# This function streams every document of the collection named in the params.
+def export_job(job_db, params):
+    collection = job_db[params['collection']]
+    return collection.find({}).batch_size(JOB_CHUNK_SIZE), collection.estimated_document_count()
+
+# This function rebuilds the sales buckets and returns a summary of the rebuild.
+def rebuild_sales_by_period_job(job_db, params):
+    return [rebuild_sales_by_period(job_db)], 1
+
+# The job types that can be submitted, mapped to the function producing their documents.
+# Each function returns an iterable of the documents to write and the expected number of documents.
+JOB_TYPES = {
+    'orders-details': orders_details_job,
+    'total-sales-per-customer': total_sales_per_customer_job,
+    'total-orders-per-customer': total_orders_per_customer_job,
+    'export': export_job
+}
+
+# The job types started by the maintenance endpoints, which cannot be submitted through the jobs endpoint.
+MAINTENANCE_JOB_TYPES = {
+    'rebuild-sales-by-period': rebuild_sales_by_period_job
+}
+
+# The params each job type requires, mapped to their allowed values. Any other param is rejected.
+JOB_PARAMS = {
+    'orders-details': {},
+    'total-sales-per-customer': {},
+    'total-orders-per-customer': {},
+    'export': {'collection': EXPORTABLE_COLLECTIONS}
+}
+
+# This function marks a job as failed, unless it has already finished.
+def fail_job(jobs, job_id, error):
+    now = datetime.utcnow()
+    jobs.update_one(
+        {'_id': ObjectId(job_id), 'active': True},
+        {'$set': {'status': 'failed', 'error': error, 'finished_at': now, 'updated_at': now}, '$unset': {'active': ''}}
+    )
+
+# This function runs a job inside a worker process.
+# The workers are forked from the request submitting a job, so they inherit the pymongo timeout of that request
+# and their MongoDB calls would fail once its time budget has passed. Running the job in a fresh context drops that timeout.
+def run_job(job_id):
+    contextvars.Context().run(execute_job, job_id)
+
+'''
+This function executes a job, see run_job.
+The worker opens its own MongoDB connection, as a client must not be shared across forked processes,
+and runs the job against the database of the server that submitted it.
+It only starts jobs that are still queued, so a job marked as stale before it started never runs.
+While the job runs, a background thread refreshes its updated_at heartbeat every JOB_HEARTBEAT_INTERVAL.
+The documents produced by the job are written to a JSON file, JOB_CHUNK_SIZE documents at a time,
+updating the progress of the job after each chunk and stopping if the job is no longer active.
+The file is written under a temporary name and renamed once complete, so a download never sees a partial file.
+'''
+def execute_job(job_id):
+    job_client = MongoClient(uri)
+    jobs = job_client[DATABASE_NAME]['jobs']
+    result_path = os.path.join(JOBS_DIR, f'{job_id}.json')
+    stop_heartbeat = threading.Event()
+    heartbeat = None
+    try:
+        now = datetime.utcnow()
+        job = jobs.find_one_and_update(
+            {'_id': ObjectId(job_id), 'status': 'queued', 'active': True},
+            {'$set': {'status': 'running', 'started_at': now, 'updated_at': now}},
+            return_document=ReturnDocument.AFTER
+        )
+        if job is None:
+            return
+
+        def send_heartbeats():
+            while not stop_heartbeat.wait(JOB_HEARTBEAT_INTERVAL.total_seconds()):
+                jobs.update_one({'_id': job['_id'], 'active': True}, {'$set': {'updated_at': datetime.utcnow()}})
+        heartbeat = threading.Thread(target=send_heartbeats, daemon=True)
+        heartbeat.start()
+
+        job_function = JOB_TYPES.get(job['type']) or MAINTENANCE_JOB_TYPES[job['type']]
+        documents, total = job_function(job_client[job.get('database', DATABASE_NAME)], job['params'])
+
+        os.makedirs(JOBS_DIR, exist_ok=True)
+        written = 0
+        with open(result_path + '.part', 'w') as file:
+            file.write('[')
+            chunk = []
+            for document in documents:
+                chunk.append(app.json.dumps(document))
+                if len(chunk) == JOB_CHUNK_SIZE:
+                    file.write((',' if written else '') + ','.join(chunk))
+                    written += len(chunk)
+                    chunk = []
+                    progress = jobs.update_one(
+                        {'_id': job['_id'], 'active': True},
+                        {'$set': {'progress': min(99, written * 100 // max(total, 1)), 'updated_at': datetime.utcnow()}}
+                    )
+                    if progress.matched_count == 0:
+                        raise RuntimeError('The job is no longer active.')
+            if chunk:
+                file.write((',' if written else '') + ','.join(chunk))
+                written += len(chunk)
+            file.write(']')
+        os.replace(result_path + '.part', result_path)
+
+        now = datetime.utcnow()
+        completed = jobs.update_one({'_id': job['_id'], 'active': True}, {
+            '$set': {
+                'status': 'completed',
+                'progress': 100,
+                'result_path': result_path,
+                'result_count': written,
+                'finished_at': now,
+                'updated_at': now,
+                'expires_at': now + JOB_RESULT_TTL
+            },
+            '$unset': {'active': ''}
+        })
+        # The job was marked as failed while it ran, so its result is discarded.
+        if completed.matched_count == 0:
+            os.remove(result_path)
+    except Exception as e:
+        fail_job(jobs, job_id, str(e))
+        if os.path.exists(result_path + '.part'):
+            os.remove(result_path + '.part')
+    finally:
+        stop_heartbeat.set()
+        if heartbeat is not None:
+            heartbeat.join()
+        job_client.close()
+
+# This function is called when the future of a job is done.
+# execute_job handles its own errors, so an exception here means the worker process died, e.g. it ran out of memory.
+# In that case the job is marked as failed, and the pool is discarded if it broke.
+def handle_job_done(job_id, executor, future):
+    if future.cancelled():
+        fail_job(jobs_collection, job_id, 'The job was cancelled.')
+        return
+    error = future.exception()
+    if error is None:
+        return
+    if isinstance(error, BrokenProcessPool):
+        reset_job_executor(executor)
+    fail_job(jobs_collection, job_id, f'The job worker stopped unexpectedly: {error}')
+
+# This function hands a job over to the process pool.
+# If the pool is broken, it is replaced and the submission is retried once.
+def start_job(job_id):
+    for attempt in range(2):
+        executor = get_job_executor()
+        try:
+            future = executor.submit(run_job, job_id)
+        except BrokenProcessPool:
+            reset_job_executor(executor)
+            continue
+        future.add_done_callback(lambda future: handle_job_done(job_id, executor, future))
+        return
+    raise BrokenProcessPool('The job workers could not be started.')
+
+# This function returns the key identifying identical jobs.
+def get_job_key(job_type, params):
+    return f'{db.name}:{job_type}:{json.dumps(params, sort_keys=True)}'
+
+# This function returns a new job document, ready to be inserted in the jobs collection.
+def new_job(job_type, params):
+    now = datetime.utcnow()
+    return {
+        'type': job_type,
+        'params': params,
+        'job_key': get_job_key(job_type, params),
+        'database': db.name,
+        'status': 'queued',
+        'progress': 0,
+        'active': True,
+        'created_at': now,
+        'updated_at': now
+    }
+
+'''
+This function cleans up after the jobs, it is called whenever jobs are submitted or polled.
+Active jobs whose heartbeat is older than JOB_STALE_AFTER are considered lost and marked as failed,
+e.g. because the server process running them was restarted.
+The partial result files of the jobs that are no longer active are deleted.
+The result files of the jobs that completed more than JOB_RESULT_TTL ago are deleted, the jobs being kept marked as expired.
+'''
+def cleanup_jobs():
+    now = datetime.utcnow()
+    jobs_collection.update_many(
+        {'active': True, 'updated_at': {'$lt': now - JOB_STALE_AFTER}},
+        {'$set': {'status': 'failed', 'error': 'The job stopped sending heartbeats.', 'finished_at': now, 'updated_at': now}, '$unset': {'active': ''}}
+    )
+
+    if os.path.isdir(JOBS_DIR):
+        for file_name in os.listdir(JOBS_DIR):
+            if not file_name.endswith('.json.part'):
+                continue
+            job_id = file_name[:-len('.json.part')]
+            if ObjectId.is_valid(job_id) and jobs_collection.count_documents({'_id': ObjectId(job_id), 'active': True}, limit=1):
+                continue
+            try:
+                os.remove(os.path.join(JOBS_DIR, file_name))
+            except FileNotFoundError:
+                pass
+
+    for job in jobs_collection.find({'status': 'completed', 'expires_at': {'$lte': now}}, {'result_path': 1}):
+        if os.path.exists(job['result_path']):
+            os.remove(job['result_path'])
+        jobs_collection.update_one({'_id': job['_id'], 'status': 'completed'}, {'$set': {'status': 'expired'}, '$unset': {'result_path': ''}})
+
+# This function converts a job document into its JSON representation.
+def format_job(job):
+    formatted_job = {
+        'id': str(job['_id']),
+        'type': job['type'],
+        'params': job['params'],
+        'status': job['status'],
+        'progress': job['progress'],
+        'created_at': job['created_at'].isoformat(),
+    }
+    for field in ('started_at', 'updated_at', 'finished_at', 'expires_at'):
+        if job.get(field):
+            formatted_job[field] = job[field].isoformat()
+    if job.get('result_count') is not None:
+        formatted_job['result_count'] = job['result_count']
+    if job.get('error'):
+        formatted_job['error'] = job['error']
+    return formatted_job
+
+'''
+This function creates a job and hands it over to the process pool.
+If an identical job is already queued or running, that job is returned instead of starting a new one.
+Lost jobs are marked as failed first, see cleanup_jobs, so they do not block a new identical job.
+Returns the job and whether it was created.
+'''
+def submit_new_job(job_type, params):
+    cleanup_jobs()
+    job = new_job(job_type, params)
+    try:
+        jobs_collection.insert_one(job)
+    except DuplicateKeyError:
+        existing_job = jobs_collection.find_one({'job_key': job['job_key'], 'active': True})
+        if existing_job is not None:
+            return existing_job, False
+        raise
+
+    try:
+        start_job(str(job['_id']))
+    except Exception as e:
+        fail_job(jobs_collection, job['_id'], f'The job could not be started: {e}')
+        raise
+    return job, True
+
+# This function finds a job by the id provided in the URL, returning None if the id is invalid or unknown.
+def find_job(job_id):
+    try:
+        return jobs_collection.find_one({'_id': ObjectId(job_id)})
+    except InvalidId:
+        return None
+
+'''
+This endpoint submits a background job.
+It takes the job type and its params as input, e.g. {"type": "export", "params": {"collection": "orders"}}.
+If an identical job is already queued or running, that job is returned instead of starting a new one.
+'''
+@app.route('/api/jobs', methods=['POST'])
+@admission_control('interactive')
+def submit_job():
+    try:
+        data = request.get_json(silent=True) or {}
+        job_type = data.get('type')
+        params = data.get('params') or {}
+        if job_type not in JOB_TYPES:
+            return make_response(jsonify({'error': f'type must be one of {", ".join(JOB_TYPES)}.'}), 400)
+        if not isinstance(params, dict):
+            return make_response(jsonify({'error': 'params must be an object.'}), 400)
+        allowed_params = JOB_PARAMS[job_type]
+        unknown_params = [name for name in params if name not in allowed_params]
+        if unknown_params:
+            return make_response(jsonify({'error': f'Unknown params for {job_type}.', 'params': unknown_params}), 400)
+        for name, allowed_values in allowed_params.items():
+            if params.get(name) not in allowed_values:
+                return make_response(jsonify({'error': f'{name} must be one of {", ".join(allowed_values)}.'}), 400)
+
+        job, created = submit_new_job(job_type, params)
+        return make_response(jsonify(format_job(job)), 202 if created else 200)
+    except Exception as e:
+        raise_if_timeout(e)
+        return make_response(jsonify({'error': str(e)}), 500)
+
+# This endpoint returns the status and progress of a job.
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+@admission_control('interactive')
+def get_job(job_id):
+    cleanup_jobs()
+    job = find_job(job_id)
+    if job is None:
+        return make_response(jsonify({'error': 'No job found.'}), 404)
+    return make_response(jsonify(format_job(job)), 200)
+
+# This endpoint downloads the result of a completed job.
+# The file is streamed from disk rather than loaded into memory.
+@app.route('/api/jobs/<job_id>/download', methods=['GET'])
+@admission_control('interactive')
+def download_job_result(job_id):
+    cleanup_jobs()
+    job = find_job(job_id)
+    if job is None:
+        return make_response(jsonify({'error': 'No job found.'}), 404)
+    if job['status'] == 'expired' or (job['status'] == 'completed' and not os.path.exists(job['result_path'])):
+        return make_response(jsonify({'error': 'The result of this job is no longer available.'}), 410)
+    if job['status'] != 'completed':
+        return make_response(jsonify({'error': f'The job is {job["status"]}.', 'progress': job['progress']}), 409)
+    return send_file(job['result_path'], mimetype='application/json', as_attachment=True, download_name=f'{job["type"]}-{job_id}.json')
+
+
 ############################ Authentication Endpoints ############################
 
 # This endpoint signs up a new admin.
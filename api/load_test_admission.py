@@ -0,0 +1,163 @@
+# This script load tests the admission control of the backend.
+# It measures the latency of a cheap interactive route on its own, then again while the expensive analytics
+# routes are flooded with requests. With admission control the interactive p99 should barely move,
+# while the excess analytics requests are shed with 503 responses.
+#
+# Usage:
+#   python api/load_test_admission.py [base_url] [--duration SECONDS]
+#     Runs the load against an already running server (npm run flask-dev).
+#   python api/load_test_admission.py --compare [--simulated] [--duration SECONDS] [--port PORT]
+#     Starts the server itself twice, first with budgets high enough to disable admission control,
+#     then with the configured budgets, and compares the interactive p99 of both runs.
+#     The server reads MONGO_URI and SECRET_KEY from the environment or the .env file as usual.
+#     With --simulated, the server runs against the simulated MongoDB of load_test_backend.py instead,
+#     so the comparison can be reproduced without a database server.
+import argparse
+import os
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+INTERACTIVE_ROUTE = '/api/get-customer-by-customer-id?customer_id=301'
+ANALYTICS_ROUTES = [
+    '/api/fetch-orders-with-details',
+    '/api/total-sales-per-customer',
+    '/api/orders-with-number-of-products?num_products=2',
+]
+INTERACTIVE_CLIENTS = 4
+ANALYTICS_CLIENTS = 24
+# Seconds after which a request is given up on and counted as an error.
+REQUEST_TIMEOUT = 30
+
+# Budgets high enough that no request ever waits, is shed or gets a time budget, i.e. no admission control.
+DISABLED_BUDGETS = {
+    f'{priority}_{setting}': '1000000'
+    for priority in ('INTERACTIVE', 'ANALYTICS')
+    for setting in ('CONCURRENCY', 'QUEUE_SIZE', 'QUEUE_TIMEOUT_MS', 'MAX_TIME_MS')
+}
+
+# Sends a GET request and returns its status code, latency in milliseconds and Retry-After header.
+def timed_get(url):
+    start = time.perf_counter()
+    retry_after = None
+    try:
+        with urllib.request.urlopen(url, timeout=REQUEST_TIMEOUT) as response:
+            response.read()
+            status = response.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+        retry_after = e.headers.get('Retry-After')
+    except (urllib.error.URLError, TimeoutError):
+        status = None
+    return status, (time.perf_counter() - start) * 1000, retry_after
+
+# Keeps requesting the given routes until the stop event is set, recording the results.
+# Like a well-behaved client, it waits for the Retry-After delay when a request is shed.
+def client_loop(base_url, routes, results, stop):
+    i = 0
+    while not stop.is_set():
+        status, latency, retry_after = timed_get(base_url + routes[i % len(routes)])
+        results.append((status, latency))
+        if retry_after is not None:
+            stop.wait(float(retry_after))
+        i += 1
+
+def percentile(values, p):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+# Returns the p99 latency of the interactive requests.
+# Failed requests count with the time they took, so a route starved of connections does not look fast.
+def interactive_p99(results):
+    return percentile([latency for status, latency in results], 99)
+
+# Runs the interactive clients, and the analytics clients if flood is set, for the given duration.
+def run_phase(base_url, duration, flood):
+    stop = threading.Event()
+    interactive_results, analytics_results = [], []
+    threads = [threading.Thread(target=client_loop, args=(base_url, [INTERACTIVE_ROUTE], interactive_results, stop)) for _ in range(INTERACTIVE_CLIENTS)]
+    if flood:
+        threads += [threading.Thread(target=client_loop, args=(base_url, ANALYTICS_ROUTES, analytics_results, stop)) for _ in range(ANALYTICS_CLIENTS)]
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return interactive_results, analytics_results
+
+def report(name, results):
+    latencies = [latency for status, latency in results if status == 200]
+    shed = sum(1 for status, _ in results if status in (503, 504))
+    errors = sum(1 for status, _ in results if status not in (200, 503, 504))
+    print(f'{name}: {len(results)} requests, {len(latencies)} ok (p50 {percentile(latencies, 50):.1f} ms, p99 {percentile(latencies, 99):.1f} ms), {shed} shed, {errors} errors')
+
+# Measures the interactive p99 without and then with the analytics flood. Returns both p99 values.
+def run_load_test(base_url, duration):
+    print(f'  Interactive traffic only ({duration:.0f}s)')
+    interactive_results, _ = run_phase(base_url, duration, flood=False)
+    report('    interactive', interactive_results)
+    baseline_p99 = interactive_p99(interactive_results)
+
+    print(f'  Interactive traffic with {ANALYTICS_CLIENTS} analytics clients ({duration:.0f}s)')
+    interactive_results, analytics_results = run_phase(base_url, duration, flood=True)
+    report('    interactive', interactive_results)
+    report('    analytics', analytics_results)
+    flooded_p99 = interactive_p99(interactive_results)
+
+    print(f'  Interactive p99 went from {baseline_p99:.1f} ms to {flooded_p99:.1f} ms under analytics load.')
+    return baseline_p99, flooded_p99
+
+# Starts the Flask server with the given environment overrides and waits until it answers.
+def start_server(port, env_overrides, simulated):
+    env = dict(os.environ, **env_overrides)
+    if simulated:
+        command = [sys.executable, 'load_test_backend.py', '--port', str(port)]
+    else:
+        command = [sys.executable, '-m', 'flask', '--app', 'index', 'run', '-p', str(port), '--with-threads']
+    server = subprocess.Popen(
+        command, cwd=os.path.dirname(os.path.abspath(__file__)), env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    base_url = f'http://127.0.0.1:{port}'
+    for _ in range(120):
+        if timed_get(base_url + '/api/server_connectivity')[0] == 200:
+            return server, base_url
+        time.sleep(0.5)
+    server.terminate()
+    raise RuntimeError('The server did not start.')
+
+# Runs the load test against a server without admission control, then against one with it.
+def compare(port, duration, simulated):
+    summary = []
+    for name, env_overrides in (('without admission control', DISABLED_BUDGETS), ('with admission control', {})):
+        print(f'Server {name}')
+        server, base_url = start_server(port, env_overrides, simulated)
+        try:
+            summary.append((name,) + run_load_test(base_url, duration))
+        finally:
+            server.terminate()
+            server.wait()
+    print('Interactive p99 (ms)          alone    under analytics load')
+    for name, baseline_p99, flooded_p99 in summary:
+        print(f'{name:<28}{baseline_p99:>8.1f}{flooded_p99:>12.1f}')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test the admission control of the backend.')
+    parser.add_argument('base_url', nargs='?', default='http://localhost:5328')
+    parser.add_argument('--duration', type=float, default=20)
+    parser.add_argument('--compare', action='store_true', help='start the server with and without admission control and compare them')
+    parser.add_argument('--port', type=int, default=5329)
+    parser.add_argument('--simulated', action='store_true', help='with --compare, run the server against the simulated MongoDB of load_test_backend.py')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(args.port, args.duration, args.simulated)
+    else:
+        run_load_test(args.base_url, args.duration)
+        with urllib.request.urlopen(args.base_url + '/api/admission-stats') as response:
+            print(response.read().decode('utf-8'))
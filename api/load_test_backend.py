@@ -0,0 +1,85 @@
+# This script starts the backend against a simulated MongoDB, to load test the admission control without a database server.
+# The simulated database is an in-memory mongomock database seeded with generated products, customers and orders.
+# It sits behind a bounded pool of MONGO_MAX_POOL_SIZE connections that adds a fixed latency to every query,
+# so requests wait on connections as they would against a real server, rather than on the Python GIL.
+# The latencies are a model: the results show how the admission control behaves, not how fast the backend is against MongoDB.
+#
+# Usage (requires mongomock, which is not a dependency of the backend: pip install mongomock):
+#   python api/load_test_backend.py [--port PORT]
+#   python api/load_test_admission.py --compare --simulated
+import argparse
+import os
+import random
+import threading
+import time
+
+import mongomock
+import mongomock.collection
+import pymongo
+
+# Simulated latency of each query, in seconds. The aggregations stand for the expensive analytics reports.
+QUERY_LATENCIES = {
+    'aggregate': 0.5,
+    'find': 0.002,
+    'find_one': 0.002
+}
+SEED_CUSTOMERS = 49
+SEED_PRODUCTS = 59
+SEED_ORDERS = 400
+
+connection_pool = threading.BoundedSemaphore(int(os.getenv('MONGO_MAX_POOL_SIZE', 100)))
+held_connection = threading.local()
+
+# Makes a query method take a connection from the pool for the duration of the query, and wait for the simulated latency.
+def add_latency(name, seconds):
+    query = getattr(mongomock.collection.Collection, name)
+    def query_with_latency(self, *args, **kwargs):
+        # Nested queries, e.g. mongomock runs $lookup through find, reuse the connection already held.
+        if getattr(held_connection, 'held', False):
+            return query(self, *args, **kwargs)
+        with connection_pool:
+            held_connection.held = True
+            try:
+                time.sleep(seconds)
+                return query(self, *args, **kwargs)
+            finally:
+                held_connection.held = False
+    setattr(mongomock.collection.Collection, name, query_with_latency)
+
+# Fills the simulated database with generated data, the same every run.
+def seed(db):
+    rng = random.Random(1)
+    db['customers'].insert_many([
+        {'_id': 300 + i, 'name': f'Customer {i}', 'membership_status': 'Member', 'contact': {'email': f'customer{i}@example.com'}}
+        for i in range(1, SEED_CUSTOMERS + 1)
+    ])
+    db['products'].insert_many([
+        {'_id': 200 + i, 'name': f'Product {i}', 'category': rng.choice(['Chairs', 'Beds', 'Shelves']), 'price': round(10 + rng.random() * 200, 2)}
+        for i in range(1, SEED_PRODUCTS + 1)
+    ])
+    db['orders'].insert_many([
+        {
+            '_id': 400 + i,
+            'customer_id': 300 + rng.randint(1, SEED_CUSTOMERS),
+            'products': [{'product_id': 200 + rng.randint(1, SEED_PRODUCTS), 'quantity': rng.randint(1, 3)} for _ in range(rng.randint(1, 3))],
+            'order_date': f'2023-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}',
+            'delivery_status': 'Pending',
+            'order_status': 'Awaiting'
+        }
+        for i in range(1, SEED_ORDERS + 1)
+    ])
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Start the backend against a simulated MongoDB.')
+    parser.add_argument('--port', type=int, default=5329)
+    args = parser.parse_args()
+
+    # The backend connects when it is imported, so MongoClient is replaced first.
+    simulated_client = mongomock.MongoClient()
+    pymongo.MongoClient = lambda *args, **kwargs: simulated_client
+    seed(simulated_client['ikea_database'])
+    for name, seconds in QUERY_LATENCIES.items():
+        add_latency(name, seconds)
+
+    from index import app
+    app.run(host='127.0.0.1', port=args.port, threaded=True)
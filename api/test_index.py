@@ -1,7 +1,15 @@
 # This file contains all the unit tests for the backend of our application.
 import pytest
 import json
-from index import app
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+import jwt
+from bson import ObjectId
+from pymongo.errors import DuplicateKeyError, ExecutionTimeout
+import index
+from index import app, AdmissionLimiter, products_collection, jobs_collection, new_job, run_job
 
 @pytest.fixture
 def client():
@@ -135,5 +143,292 @@ def test_update_order_status(client):
     assert 'message' in data
     assert data['message'] == 'Order 401 marked as Awaiting successfully !'
 
+def test_sales_by_period(client):
+    response = client.get('/api/sales-by-period?start_date=2023-01-01&end_date=2023-12-31&granularity=month&group_by=category')
+    assert response.status_code == 200
+    data = json.loads(response.data)
+    assert isinstance(data, list)
+
+def test_sales_by_period_invalid_granularity(client):
+    response = client.get('/api/sales-by-period?start_date=2023-01-01&end_date=2023-12-31&granularity=year')
+    assert response.status_code == 400
+
+# Returns a valid token for the endpoints that require a logged in admin.
+def get_auth_headers():
+    token = jwt.encode({'id': 'test', 'user': 'test', 'exp': datetime.utcnow() + timedelta(minutes=5)}, app.config['SECRET_KEY'], algorithm='HS256')
+    return {'x-access-token': token}
+
+# Returns the quantity and total sales of a product in the sales-by-period report of a single day or month.
+def get_product_sales(client, date, granularity, product_id):
+    response = client.get(f'/api/sales-by-period?start_date={date}&end_date={date}&granularity={granularity}&group_by=product')
+    assert response.status_code == 200
+    bucket = next((item for item in json.loads(response.data) if item['product'] == product_id), None)
+    return (bucket['quantity'], bucket['total_sales']) if bucket else (0, 0)
+
+# Points the app at a scratch copy of the products, customers and orders, for the tests that write orders or rebuild the sales buckets.
+# The copy is dropped afterwards, so these tests never change the shared database.
+@pytest.fixture
+def scratch_db(monkeypatch):
+    scratch = index.client[f'{index.DATABASE_NAME}_test_{ObjectId()}']
+    for name in ('products', 'customers', 'orders'):
+        documents = list(index.db[name].find({}))
+        if documents:
+            scratch[name].insert_many(documents)
+    index.create_sales_by_period_indexes(scratch['sales_by_period'])
+    monkeypatch.setattr(index, 'db', scratch)
+    for name in ('products', 'customers', 'orders', 'sales_by_period', 'counters'):
+        monkeypatch.setattr(index, f'{name}_collection', scratch[name])
+    yield scratch
+    index.client.drop_database(scratch.name)
+
+# Deletes a job and its result file.
+def delete_job(job_id):
+    jobs_collection.delete_one({'_id': ObjectId(job_id)})
+    result_path = os.path.join(index.JOBS_DIR, f'{job_id}.json')
+    for path in (result_path, result_path + '.part'):
+        if os.path.exists(path):
+            os.remove(path)
+
+# Polls a job until it is no longer queued or running.
+def wait_for_job(client, job_id, timeout=60):
+    deadline = time.monotonic() + timeout
+    while True:
+        job = json.loads(client.get(f'/api/jobs/{job_id}').data)
+        if job['status'] not in ('queued', 'running') or time.monotonic() > deadline:
+            return job
+        time.sleep(0.5)
+
+# Migrates the order dates of the scratch database and waits for the rebuild of its sales buckets.
+def migrate_order_dates(client):
+    response = client.post('/api/migrate-order-dates', headers=get_auth_headers())
+    assert response.status_code == 202
+    data = json.loads(response.data)
+    try:
+        job = wait_for_job(client, data['rebuild_job']['id'])
+        assert job['status'] == 'completed', job.get('error')
+    finally:
+        delete_job(data['rebuild_job']['id'])
+    return data
+
+def test_create_order_updates_sales_buckets(client, scratch_db):
+    product = json.loads(client.get('/api/find-products-by-product-ids?product_ids=201').data)[0]
+    day_before = get_product_sales(client, '2099-01-15', 'day', 201)
+    month_before = get_product_sales(client, '2099-01-15', 'month', 201)
+
+    response = client.post('/api/create-order', json={
+        'customer_id': 301,
+        'products': [{'product_id': 201, 'quantity': 2}],
+        'order_date': '2099-01-15'
+    })
+    assert response.status_code == 201
+    order_id = json.loads(response.data)['order_id']
+    order = scratch_db['orders'].find_one({'_id': order_id})
+    assert order['total_price'] == round(product['price'] * 2, 2)
+    assert 'sales_pending' not in order
+
+    day_after = get_product_sales(client, '2099-01-15', 'day', 201)
+    month_after = get_product_sales(client, '2099-01-15', 'month', 201)
+    assert day_after[0] - day_before[0] == 2
+    assert month_after[0] - month_before[0] == 2
+    assert day_after[1] - day_before[1] == pytest.approx(product['price'] * 2, abs=0.01)
+
+def test_create_order_during_rebuild_is_replayed(client, scratch_db):
+    index.set_sales_rebuilding(scratch_db, True)
+    response = client.post('/api/create-order', json={
+        'customer_id': 301,
+        'products': [{'product_id': 201, 'quantity': 3}],
+        'order_date': '2099-03-10'
+    })
+    assert response.status_code == 201
+    order_id = json.loads(response.data)['order_id']
+    assert scratch_db['orders'].find_one({'_id': order_id})['sales_pending'] is True
+    assert get_product_sales(client, '2099-03-10', 'day', 201) == (0, 0)
+
+    index.set_sales_rebuilding(scratch_db, False)
+    assert index.replay_pending_order_sales(scratch_db) == 1
+    assert index.replay_pending_order_sales(scratch_db) == 0
+    assert 'sales_pending' not in scratch_db['orders'].find_one({'_id': order_id})
+    assert get_product_sales(client, '2099-03-10', 'day', 201)[0] == 3
+
+def test_create_order_rejects_invalid_orders(client, scratch_db):
+    orders_before = scratch_db['orders'].count_documents({})
+    response = client.post('/api/create-order', json={'customer_id': 301, 'products': [{'product_id': 201}]})
+    assert response.status_code == 400
+    response = client.post('/api/create-order', json={'customer_id': 301, 'products': [{'product_id': 201, 'quantity': 1}], 'order_date': 20240131})
+    assert response.status_code == 400
+    response = client.post('/api/create-order', json={'customer_id': 301, 'products': [{'product_id': -1, 'quantity': 1}]})
+    assert response.status_code == 400
+    assert scratch_db['orders'].count_documents({}) == orders_before
+
+def test_migrate_order_dates(client, scratch_db):
+    scratch_db['orders'].insert_one({
+        '_id': index.next_order_id(),
+        'customer_id': 301,
+        'products': [{'product_id': 201, 'quantity': 1}],
+        'order_date': '2099-02-01',
+        'delivery_status': 'Pending',
+        'order_status': 'Awaiting'
+    })
+    data = migrate_order_dates(client)
+    assert data['migrated_orders'] >= 1
+    assert scratch_db['orders'].count_documents({'order_date': {'$type': 'string'}}) == 0
+    assert scratch_db['orders'].find_one({'order_date': datetime(2099, 2, 1)}) is not None
+    assert get_product_sales(client, '2099-02-01', 'day', 201)[0] == 1
+
+def test_sales_buckets_match_total_sales_per_customer(client, scratch_db):
+    # Rebuilding the buckets so that they match the orders of the scratch database.
+    migrate_order_dates(client)
+
+    response = client.get('/api/sales-by-period?start_date=1900-01-01&end_date=2100-12-31&granularity=month&group_by=category')
+    bucket_total = sum(item['total_sales'] for item in json.loads(response.data))
+    response = client.get('/api/total-sales-per-customer')
+    customer_total = sum(item['total_sale'] for item in json.loads(response.data))
+    assert bucket_total == pytest.approx(customer_total, rel=1e-3)
+
+def test_run_job_writes_result(client):
+    job = new_job('export', {'collection': 'products'})
+    # A unique key, so that the job does not collide with an identical job submitted through the API.
+    job['job_key'] = f"test:{job['job_key']}:{time.time()}"
+    jobs_collection.insert_one(job)
+    try:
+        run_job(str(job['_id']))
+
+        finished_job = jobs_collection.find_one({'_id': job['_id']})
+        assert finished_job['status'] == 'completed'
+        assert 'active' not in finished_job
+        assert finished_job['result_count'] == products_collection.count_documents({})
+        with open(finished_job['result_path']) as file:
+            assert len(json.load(file)) == finished_job['result_count']
+
+        response = client.get(f"/api/jobs/{job['_id']}/download")
+        assert response.status_code == 200
+        assert len(json.loads(response.data)) == finished_job['result_count']
+    finally:
+        delete_job(str(job['_id']))
+
+def test_polling_fails_lost_jobs_and_deletes_their_partial_results(client):
+    job = new_job('export', {'collection': 'products'})
+    job['job_key'] = f"test:{job['job_key']}:{time.time()}"
+    job['status'] = 'running'
+    job['updated_at'] = datetime.utcnow() - index.JOB_STALE_AFTER - timedelta(minutes=1)
+    jobs_collection.insert_one(job)
+    job_id = str(job['_id'])
+    # A partial result left behind by a worker that died, and one of the lost job.
+    orphan_path = os.path.join(index.JOBS_DIR, f'{ObjectId()}.json.part')
+    part_path = os.path.join(index.JOBS_DIR, f'{job_id}.json.part')
+    os.makedirs(index.JOBS_DIR, exist_ok=True)
+    for path in (orphan_path, part_path):
+        open(path, 'w').close()
+    try:
+        response = client.get(f'/api/jobs/{job_id}')
+        assert response.status_code == 200
+        assert json.loads(response.data)['status'] == 'failed'
+        assert 'active' not in jobs_collection.find_one({'_id': job['_id']})
+        assert not os.path.exists(orphan_path)
+        assert not os.path.exists(part_path)
+    finally:
+        delete_job(job_id)
+        if os.path.exists(orphan_path):
+            os.remove(orphan_path)
+
+def test_submitted_jobs_outlive_the_request_budget(client, monkeypatch):
+    # The job workers are forked from the request submitting a job, under its MongoDB time budget.
+    # A new pool is started with a short budget, and a second job is submitted to the same worker once that budget has passed.
+    monkeypatch.setattr(index.admission_limiters['submit_job'], 'max_time_ms', 2000)
+    index.reset_job_executor(index.get_job_executor())
+    job_ids = []
+    try:
+        for collection in ('products', 'customers'):
+            response = client.post('/api/jobs', json={'type': 'export', 'params': {'collection': collection}})
+            assert response.status_code in (200, 202)
+            job_ids.append(json.loads(response.data)['id'])
+            time.sleep(2.5)
+
+        for job_id in job_ids:
+            job = wait_for_job(client, job_id)
+            assert job['status'] == 'completed', job.get('error')
+            assert client.get(f'/api/jobs/{job_id}/download').status_code == 200
+    finally:
+        for job_id in job_ids:
+            delete_job(job_id)
+
+def test_submit_identical_job_returns_active_job(client):
+    job = new_job('total-sales-per-customer', {})
+    try:
+        try:
+            jobs_collection.insert_one(job)
+            job_id = str(job['_id'])
+        except DuplicateKeyError:
+            job_id = str(jobs_collection.find_one({'job_key': job['job_key'], 'active': True})['_id'])
+
+        response = client.post('/api/jobs', json={'type': 'total-sales-per-customer'})
+        assert response.status_code == 200
+        assert json.loads(response.data)['id'] == job_id
+    finally:
+        jobs_collection.delete_one({'_id': job['_id']})
 
+def test_submit_job_unknown_params(client):
+    response = client.post('/api/jobs', json={'type': 'orders-details', 'params': {'x': 1}})
+    assert response.status_code == 400
 
+def test_submit_job_invalid_type(client):
+    response = client.post('/api/jobs', json={'type': 'unknown'})
+    assert response.status_code == 400
+
+def test_get_unknown_job(client):
+    response = client.get('/api/jobs/unknown')
+    assert response.status_code == 404
+
+def test_admission_stats(client):
+    response = client.get('/api/admission-stats')
+    assert response.status_code == 200
+    data = json.loads(response.data)
+    assert data['fetch_orders_details']['priority'] == 'analytics'
+    assert data['find_customer_by_customer_id']['priority'] == 'interactive'
+
+def test_admission_limiter_rejects_when_queue_full():
+    limiter = AdmissionLimiter('analytics', concurrency=1, queue_size=0, queue_timeout_ms=100, max_time_ms=1000)
+    assert limiter.acquire(time.monotonic() + 0.1)
+    assert not limiter.acquire(time.monotonic() + 0.1)
+    limiter.release()
+    assert limiter.acquire(time.monotonic() + 0.1)
+    assert limiter.stats()['rejected_queue_full'] == 1
+
+def test_admission_limiter_rejects_after_deadline():
+    limiter = AdmissionLimiter('analytics', concurrency=1, queue_size=1, queue_timeout_ms=100, max_time_ms=1000)
+    assert limiter.acquire(time.monotonic() + 0.1)
+    assert not limiter.acquire(time.monotonic() + 0.05)
+    assert limiter.stats()['rejected_deadline'] == 1
+    assert limiter.stats()['queue_depth'] == 0
+
+def test_admission_limiter_serves_the_queue_in_order():
+    limiter = AdmissionLimiter('analytics', concurrency=1, queue_size=2, queue_timeout_ms=5000, max_time_ms=5000)
+    assert limiter.acquire(time.monotonic())
+    admitted = []
+    threads = []
+    for name in ('first', 'second'):
+        thread = threading.Thread(target=lambda name=name: limiter.acquire(time.monotonic() + 5) and admitted.append(name))
+        thread.start()
+        threads.append(thread)
+        while limiter.stats()['queue_depth'] < len(threads):
+            time.sleep(0.01)
+
+    limiter.release()
+    # A new request cannot take the freed slot from the queued ones.
+    assert not limiter.acquire(time.monotonic())
+    threads[0].join(5)
+    limiter.release()
+    threads[1].join(5)
+    assert admitted == ['first', 'second']
+
+def test_admission_control_answers_timeouts_with_504(client, monkeypatch):
+    class TimingOutCollection:
+        def find(self, *args, **kwargs):
+            raise ExecutionTimeout('operation exceeded time limit', 50)
+    timed_out_before = json.loads(client.get('/api/admission-stats').data)['find_orders_by_order_ids']['timed_out']
+    monkeypatch.setattr(index, 'orders_collection', TimingOutCollection())
+
+    response = client.get('/api/find-orders-by-order-ids?order_ids=404')
+    assert response.status_code == 504
+    assert 'Retry-After' in response.headers
+    assert json.loads(client.get('/api/admission-stats').data)['find_orders_by_order_ids']['timed_out'] == timed_out_before + 1